@@ -659,6 +659,9 @@ async def post_init(application: Application):
         BotCommand("/help", "Show help message"),
     ])
 
+async def post_shutdown(application: Application):
+    await openai_utils.close_aiosession()
+
 def run_bot() -> None:
     application = (
         ApplicationBuilder()
@@ -666,6 +669,7 @@ def run_bot() -> None:
         .concurrent_updates(True)
         .rate_limiter(AIORateLimiter(max_retries=5))
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
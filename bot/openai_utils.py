@@ -1,6 +1,12 @@
 import config
 
-import tiktoken
+import asyncio
+import aiohttp
+import random
+import re
+from collections import deque
+from functools import lru_cache
+
 import openai
 openai.api_key = config.openai_api_key
 
@@ -13,31 +19,75 @@ OPENAI_COMPLETION_OPTIONS = {
     "presence_penalty": 0
 }
 
+CHAT_COMPLETION_MODELS = frozenset({"gpt-3.5-turbo", "gpt-4"})
+COMPLETION_MODELS = frozenset({"text-davinci-003"})
+
+# model -> (tokens_per_message, tokens_per_name)
+MESSAGE_TOKEN_OVERHEADS = {
+    "gpt-3.5-turbo": (4, -1),  # every message follows <im_start>{role/name}\n{content}<im_end>\n, if there's a name, the role is omitted
+    "gpt-4": (3, 1),
+}
+
+# used to trim dialog to fit into the context window in one pass
+DIALOG_TURN_TOKEN_OVERHEAD = 8  # role/formatting tokens of one user + assistant pair
+CONTEXT_SAFETY_MARGIN = 64  # tokens
+
+# coalesce stream deltas: yield once enough new symbols arrived or enough time passed
+STREAM_YIELD_MIN_SYMBOLS = 64
+STREAM_YIELD_MAX_INTERVAL = 0.4  # seconds
+
+# retry rate limited / overloaded requests with exponential backoff
+OPENAI_MAX_ATTEMPTS = 5
+OPENAI_BACKOFF_INITIAL = 1  # seconds
+OPENAI_BACKOFF_MAX = 30  # seconds
+
+
+@lru_cache(maxsize=8)
+def _get_encoding(model):
+    # building BPE tables is expensive, so create each encoding once per process;
+    # tiktoken is imported here to keep it off the bot startup path
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
+
+
+def _approx_n_tokens(text):
+    # ~4 symbols per token, good enough for intermediate stream updates
+    return (len(text) + 3) // 4
+
 
 class ChatGPT:
+    _system_prompts = {}  # chat_mode -> system prompt, shared by all instances
+    _semaphore = None  # limits in-flight API requests across all instances
+    _aiosession = None  # HTTP session (connection pool) shared by all instances
+
     def __init__(self, model="gpt-3.5-turbo"):
-        assert model in {"text-davinci-003", "gpt-3.5-turbo", "gpt-4"}, f"Unknown model: {model}"
+        if model not in CHAT_COMPLETION_MODELS and model not in COMPLETION_MODELS:
+            raise ValueError(f"Unknown model: {model}")
         self.model = model
 
-    async def send_message(self, message, dialog_messages=[], chat_mode="assistant"):
+    async def send_message(self, message, dialog_messages=None, chat_mode="assistant"):
         if chat_mode not in config.chat_modes.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
+        system_prompt = self._get_system_prompt(chat_mode)
+        dialog_messages = deque(dialog_messages or ())  # local copy, shrunk from the left on too many tokens
         n_dialog_messages_before = len(dialog_messages)
         answer = None
         while answer is None:
             try:
-                if self.model in {"gpt-3.5-turbo", "gpt-4"}:
-                    messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
-                    r = await openai.ChatCompletion.acreate(
+                if self.model in CHAT_COMPLETION_MODELS:
+                    messages = self._generate_prompt_messages(message, dialog_messages, system_prompt)
+                    r = await self._acreate(
+                        openai.ChatCompletion,
                         model=self.model,
                         messages=messages,
                         **OPENAI_COMPLETION_OPTIONS
                     )
                     answer = r.choices[0].message["content"]
-                elif self.model == "text-davinci-003":
-                    prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-                    r = await openai.Completion.acreate(
+                elif self.model in COMPLETION_MODELS:
+                    prompt = self._generate_prompt(message, dialog_messages, system_prompt)
+                    r = await self._acreate(
+                        openai.Completion,
                         engine=self.model,
                         prompt=prompt,
                         **OPENAI_COMPLETION_OPTIONS
@@ -49,44 +99,83 @@ class ChatGPT:
                 answer = self._postprocess_answer(answer)
                 n_input_tokens, n_output_tokens = r.usage.prompt_tokens, r.usage.completion_tokens
             except openai.error.InvalidRequestError as e:  # too many tokens
+                if not self._is_context_length_error(e):
+                    raise
+
                 if len(dialog_messages) == 0:
                     raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
 
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+                # forget first messages in dialog_messages
+                self._trim_dialog_messages_to_fit(message, dialog_messages, system_prompt, self._get_max_context_tokens(e))
 
         n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
 
         return answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
 
-    async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant"):
+    async def send_message_stream(self, message, dialog_messages=None, chat_mode="assistant"):
         if chat_mode not in config.chat_modes.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
+        system_prompt = self._get_system_prompt(chat_mode)
+        dialog_messages = deque(dialog_messages or ())  # local copy, shrunk from the left on too many tokens
+        loop = asyncio.get_running_loop()
         n_dialog_messages_before = len(dialog_messages)
         answer = None
         while answer is None:
             try:
-                if self.model in {"gpt-3.5-turbo", "gpt-4"}:
-                    messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
-                    r_gen = await openai.ChatCompletion.acreate(
+                if self.model in CHAT_COMPLETION_MODELS:
+                    messages = self._generate_prompt_messages(message, dialog_messages, system_prompt)
+
+                    # API reports usage only in the last chunk, until then input is counted locally
+                    # and output is estimated; counted before the request, so that the returned stream
+                    # (which holds a concurrency slot) is consumed right away
+                    n_input_tokens = self._count_input_tokens_from_messages(messages, model=self.model)
+                    n_output_tokens = 1
+                    n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+
+                    r_gen = await self._acreate(
+                        openai.ChatCompletion,
                         model=self.model,
                         messages=messages,
                         stream=True,
+                        stream_options={"include_usage": True},
                         **OPENAI_COMPLETION_OPTIONS
                     )
 
                     answer = ""
-                    async for r_item in r_gen:
-                        delta = r_item.choices[0].delta
-                        if "content" in delta:
-                            answer += delta.content
-                            n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer, model=self.model)
-                            n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-                            yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
-                elif self.model == "text-davinci-003":
-                    prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-                    r_gen = await openai.Completion.acreate(
+                    usage = None
+                    last_yield_len, last_yield_time = 0, loop.time()
+                    # close explicitly, so the concurrency slot is freed as soon as the caller stops reading
+                    try:
+                        async for r_item in r_gen:
+                            if r_item.get("usage"):
+                                usage = r_item.usage
+                            if len(r_item.choices) == 0:  # usage-only chunk
+                                continue
+
+                            delta = r_item.choices[0].delta
+                            if "content" in delta:
+                                answer += delta.content
+                                n_output_tokens += _approx_n_tokens(delta.content)
+                                if len(answer) - last_yield_len >= STREAM_YIELD_MIN_SYMBOLS or loop.time() - last_yield_time > STREAM_YIELD_MAX_INTERVAL:
+                                    last_yield_len, last_yield_time = len(answer), loop.time()
+                                    yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+                    finally:
+                        await r_gen.aclose()
+
+                    if usage is not None:
+                        n_input_tokens, n_output_tokens = usage.prompt_tokens, usage.completion_tokens
+                    else:
+                        n_output_tokens = 1 + len(_get_encoding(self.model).encode(answer, disallowed_special=()))
+                elif self.model in COMPLETION_MODELS:
+                    prompt = self._generate_prompt(message, dialog_messages, system_prompt)
+
+                    n_input_tokens = self._count_input_tokens_from_prompt(prompt, model=self.model)
+                    n_output_tokens = 0
+                    n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+
+                    r_gen = await self._acreate(
+                        openai.Completion,
                         engine=self.model,
                         prompt=prompt,
                         stream=True,
@@ -94,90 +183,210 @@ class ChatGPT:
                     )
 
                     answer = ""
-                    async for r_item in r_gen:
-                        answer += r_item.choices[0].text
-                        n_input_tokens, n_output_tokens = self._count_tokens_from_prompt(prompt, answer, model=self.model)
-                        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-                        yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+                    last_yield_len, last_yield_time = 0, loop.time()
+                    # close explicitly, so the concurrency slot is freed as soon as the caller stops reading
+                    try:
+                        async for r_item in r_gen:
+                            text = r_item.choices[0].text
+                            answer += text
+                            n_output_tokens += _approx_n_tokens(text)
+                            if len(answer) - last_yield_len >= STREAM_YIELD_MIN_SYMBOLS or loop.time() - last_yield_time > STREAM_YIELD_MAX_INTERVAL:
+                                last_yield_len, last_yield_time = len(answer), loop.time()
+                                yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+                    finally:
+                        await r_gen.aclose()
+
+                    n_output_tokens = len(_get_encoding(self.model).encode(answer, disallowed_special=()))
 
                 answer = self._postprocess_answer(answer)
 
             except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
+                if not self._is_context_length_error(e) or len(dialog_messages) == 0:
                     raise e
 
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+                # forget first messages in dialog_messages
+                self._trim_dialog_messages_to_fit(message, dialog_messages, system_prompt, self._get_max_context_tokens(e))
 
         yield "finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed  # sending final answer
 
-    def _generate_prompt(self, message, dialog_messages, chat_mode):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
-        prompt += "\n\n"
+    async def _acreate(self, api_resource, **kwargs):
+        # created lazily, so that semaphore and session are bound to the running event loop
+        if ChatGPT._semaphore is None:
+            ChatGPT._semaphore = asyncio.Semaphore(config.openai_max_concurrency)
+        if ChatGPT._aiosession is None:
+            ChatGPT._aiosession = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100))
+
+        for attempt in range(OPENAI_MAX_ATTEMPTS):
+            await ChatGPT._semaphore.acquire()
+            try:
+                # without openai.aiosession, openai opens a new session (and connections) per request
+                aiosession_token = openai.aiosession.set(ChatGPT._aiosession)
+                try:
+                    r = await api_resource.acreate(**kwargs)
+                finally:
+                    openai.aiosession.reset(aiosession_token)
+            except openai.error.OpenAIError as e:
+                ChatGPT._semaphore.release()
+
+                if not self._is_retryable_error(e) or attempt == OPENAI_MAX_ATTEMPTS - 1:
+                    raise
+
+                # exponential backoff with jitter
+                delay = min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_INITIAL * 2 ** attempt)
+                await asyncio.sleep(delay + random.uniform(0, OPENAI_BACKOFF_INITIAL))
+                continue
+            except BaseException:
+                ChatGPT._semaphore.release()
+                raise
+
+            if kwargs.get("stream", False):
+                # stream body is still being read, so keep the slot until it's consumed
+                return self._release_semaphore_after(r)
+
+            ChatGPT._semaphore.release()
+            return r
+
+    async def _release_semaphore_after(self, r_gen):
+        # finally also runs when the consumer is cancelled or the generator is closed early
+        try:
+            async for r_item in r_gen:
+                yield r_item
+        finally:
+            ChatGPT._semaphore.release()
+
+    def _is_retryable_error(self, e):
+        if isinstance(e, (openai.error.RateLimitError, openai.error.ServiceUnavailableError)):
+            # exhausted quota won't recover by waiting;
+            # openai sets error code only on e.error for these exceptions, e.code is None
+            return getattr(e.error, "code", None) != "insufficient_quota"
+        elif isinstance(e, (openai.error.Timeout, openai.error.APIConnectionError)):
+            return True
+        elif isinstance(e, openai.error.APIError):  # 500, 502, ...
+            return e.http_status is not None and e.http_status >= 500
+        else:
+            return False
+
+    def _is_context_length_error(self, e):
+        # only these errors can be fixed by shrinking the dialog, others would retry forever
+        return e.code == "context_length_exceeded" or "maximum context length" in str(e)
+
+    def _get_max_context_tokens(self, e):
+        # error states the actual limit, e.g. "This model's maximum context length is 16385 tokens"
+        match = re.search(r"maximum context length is (\d+) tokens", str(e))
+        if match is not None:
+            return int(match.group(1))
+
+        return config.models["info"][self.model]["max_context_tokens"]
+
+    def _trim_dialog_messages_to_fit(self, message, dialog_messages, system_prompt, n_max_context_tokens):
+        # drop as many oldest turns as needed in one pass, instead of one retry per dropped turn
+        encoding = _get_encoding(self.model)
+
+        n_budget_tokens = n_max_context_tokens - OPENAI_COMPLETION_OPTIONS["max_tokens"] - CONTEXT_SAFETY_MARGIN
+        n_budget_tokens -= sum(len(encoding.encode(text, disallowed_special=())) for text in (system_prompt, message))
+
+        texts = [text for dialog_message in dialog_messages for text in (dialog_message["user"], dialog_message["bot"])]
+        text_lens = [len(encoding.encode(text, disallowed_special=())) for text in texts]
+        turn_lens = [text_lens[i] + text_lens[i + 1] + DIALOG_TURN_TOKEN_OVERHEAD for i in range(0, len(text_lens), 2)]
+
+        # keep the longest suffix of recent turns that fits
+        n_turns_to_keep, n_tokens = 0, 0
+        for turn_len in reversed(turn_lens):
+            if n_tokens + turn_len > n_budget_tokens:
+                break
+            n_tokens += turn_len
+            n_turns_to_keep += 1
+
+        # API has rejected the current dialog, so always drop at least one turn
+        n_turns_to_keep = min(n_turns_to_keep, len(dialog_messages) - 1)
+        for _ in range(len(dialog_messages) - n_turns_to_keep):
+            dialog_messages.popleft()
+
+    def _get_system_prompt(self, chat_mode):
+        # resolve once, so that retries send a byte-identical prompt prefix
+        if chat_mode not in self._system_prompts:
+            self._system_prompts[chat_mode] = config.chat_modes[chat_mode]["prompt_start"]
+        return self._system_prompts[chat_mode]
+
+    def _generate_prompt(self, message, dialog_messages, system_prompt):
+        # collect lines and join once instead of growing the string
+        lines = [system_prompt, ""]
 
         # add chat context
+        dialog_messages = self._deduplicate_dialog_messages(dialog_messages)
         if len(dialog_messages) > 0:
-            prompt += "Chat:\n"
+            lines.append("Chat:")
             for dialog_message in dialog_messages:
-                prompt += f"User: {dialog_message['user']}\n"
-                prompt += f"Assistant: {dialog_message['bot']}\n"
+                lines.append(f"User: {dialog_message['user']}")
+                lines.append(f"Assistant: {dialog_message['bot']}")
 
         # current message
-        prompt += f"User: {message}\n"
-        prompt += "Assistant: "
-
-        return prompt
+        lines.append(f"User: {message}")
+        lines.append("Assistant: ")
 
-    def _generate_prompt_messages(self, message, dialog_messages, chat_mode):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
+        return "\n".join(lines)
 
-        messages = [{"role": "system", "content": prompt}]
-        for dialog_message in dialog_messages:
+    def _generate_prompt_messages(self, message, dialog_messages, system_prompt):
+        # keep stable parts first (system prompt, then history in order) and only append at the tail,
+        # so consecutive turns share the longest possible prompt prefix for server-side caching
+        messages = [{"role": "system", "content": system_prompt}]
+        for dialog_message in self._deduplicate_dialog_messages(dialog_messages):
             messages.append({"role": "user", "content": dialog_message["user"]})
             messages.append({"role": "assistant", "content": dialog_message["bot"]})
         messages.append({"role": "user", "content": message})
 
         return messages
 
+    def _deduplicate_dialog_messages(self, dialog_messages):
+        # drop exact repeats of earlier turns (same message sent again and answered the same way),
+        # they only add input tokens; the first occurrence is kept
+        seen = set()
+        unique_dialog_messages = []
+        for dialog_message in dialog_messages:
+            key = (dialog_message["user"], dialog_message["bot"])
+            if key in seen:
+                continue
+
+            seen.add(key)
+            unique_dialog_messages.append(dialog_message)
+
+        return unique_dialog_messages
+
     def _postprocess_answer(self, answer):
         answer = answer.strip()
         return answer
 
-    def _count_tokens_from_messages(self, messages, answer, model="gpt-3.5-turbo"):
-        encoding = tiktoken.encoding_for_model(model)
+    def _count_input_tokens_from_messages(self, messages, model="gpt-3.5-turbo"):
+        encoding = _get_encoding(model)
 
-        if model == "gpt-3.5-turbo":
-            tokens_per_message = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            tokens_per_name = -1  # if there's a name, the role is omitted
-        elif model == "gpt-4":
-            tokens_per_message = 3
-            tokens_per_name = 1
-        else:
+        if model not in MESSAGE_TOKEN_OVERHEADS:
             raise ValueError(f"Unknown model: {model}")
+        tokens_per_message, tokens_per_name = MESSAGE_TOKEN_OVERHEADS[model]
 
-        # input
         n_input_tokens = 0
         for message in messages:
             n_input_tokens += tokens_per_message
             for key, value in message.items():
-                n_input_tokens += len(encoding.encode(value))
+                n_input_tokens += len(encoding.encode(value, disallowed_special=()))
                 if key == "name":
                     n_input_tokens += tokens_per_name
 
         n_input_tokens += 2
 
-        # output
-        n_output_tokens = 1 + len(encoding.encode(answer))
+        return n_input_tokens
+
+    def _count_input_tokens_from_prompt(self, prompt, model="text-davinci-003"):
+        encoding = _get_encoding(model)
 
-        return n_input_tokens, n_output_tokens
+        n_input_tokens = len(encoding.encode(prompt, disallowed_special=())) + 1
 
-    def _count_tokens_from_prompt(self, prompt, answer, model="text-davinci-003"):
-        encoding = tiktoken.encoding_for_model(model)
+        return n_input_tokens
 
-        n_input_tokens = len(encoding.encode(prompt)) + 1
-        n_output_tokens = len(encoding.encode(answer))
 
-        return n_input_tokens, n_output_tokens
+async def close_aiosession():
+    if ChatGPT._aiosession is not None:
+        await ChatGPT._aiosession.close()
+        ChatGPT._aiosession = None
 
 
 async def transcribe_audio(audio_file):